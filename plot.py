@@ -1,41 +1,87 @@
 #%matplotlib inline
 
-import json
-import base64
-import struct
 import argparse
+import mmap
+import warnings
 
 from matplotlib import pyplot as plt
 import numpy as np
 import scipy.signal as sp
 import requests
+import orjson
+
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+_SESSION = requests.Session()
 
 #%%
 def grab_data_url(url, out_fn):
-    req = requests.get(url)
-    json_data = json.loads(req.text)
-    with open(out_fn, "w") as fp:
-        json.dump(json_data, fp)
-    return json_data
+    req = _SESSION.get(url)
+    req.raise_for_status()
+    # Dump the server's response verbatim instead of re-serializing it.
+    with open(out_fn, "wb") as fp:
+        fp.write(req.content)
+    return orjson.loads(req.content)
 
 def grab_data_file(in_fn):
-    with open(in_fn) as fp:
-        json_data = json.load(fp)
+    # Let the OS page the dump in on demand. orjson won't take an mmap, so it
+    # parses a memoryview of the mapping, which must be released before the
+    # mapping is closed. Pipes/FIFOs and empty files can't be mapped; read
+    # those normally.
+    with open(in_fn, "rb") as fp:
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return orjson.loads(fp.read())
+        with mm, memoryview(mm) as view:
+            json_data = orjson.loads(view)
     return json_data
 
+def _cupy_or_none():
+    # Only imported for --gpu so CPU runs don't pay cupy's import cost.
+    # CUDARuntimeError (no driver/device) is a RuntimeError.
+    try:
+        import cupy as cp
+        if cp.cuda.runtime.getDeviceCount() > 0:
+            return cp
+        reason = "no CUDA device found"
+    except (ImportError, RuntimeError) as e:
+        reason = str(e)
+    warnings.warn("GPU unavailable ({}), smoothing on CPU.".format(reason))
+    return None
+
 #%%
-def process_data(json_data, use_timestamp=False, windows=[15, 30, 60]):
+def process_data(json_data, use_timestamp=False, windows=[15, 30, 60], use_gpu=False):
     temps_bytestr = base64.b64decode(json_data["buf"], altchars="-_")
-    temp = [(1.8*(t/16.0) + 32) for t in struct.unpack_from("<"+"h"*(len(temps_bytestr)//2), temps_bytestr)]
-    time = [i for i in range(len(temp))]
+    # float32 is far finer than the sensor's 1/16 C resolution. Like the old
+    # struct.unpack_from, ignore a trailing odd byte.
+    temp = np.frombuffer(temps_bytestr, dtype="<i2", count=len(temps_bytestr)//2).astype(np.float32) * np.float32(1.8/16.0) + np.float32(32.0)
+    # Sample indices; slices in write_plot are zero-copy views.
+    time = np.arange(len(temp), dtype=np.int32)
 
     reltime = time # TODO: Actually calculate timestamps
 
     avg_temps = [temp]
 
     if windows != [0]:
+        # Every window width is derived from the same prefix sums, so one
+        # pass over temp is enough. Matches np.convolve(..., mode='valid').
+        # The running sum itself stays float64 so long series don't lose
+        # precision.
+        xp = np
+        if use_gpu:
+            xp = _cupy_or_none() or np
+
+        csum = xp.concatenate((xp.zeros(1), xp.cumsum(xp.asarray(temp), dtype=xp.float64)))
         for w in windows:
-            avg_temps.append({"width" : w, "data" : np.convolve(temp, np.ones((w,))/w, mode='valid')})
+            data = csum[w:] - csum[:-w]
+            data /= w
+            if xp is not np:
+                data = xp.asnumpy(data)
+            avg_temps.append({"width" : w, "data" : data})
 
     return (reltime, avg_temps)
 
@@ -65,6 +111,9 @@ def write_plot(time, avg_temps, use_timestamp=False, marker_size=1):
     ax2.tick_params(axis="y", colors=colors[1])
 
     raw, = ax.plot(time, avg_temps[0], '.', color=colors[3], markersize=marker_size)
+    # For vector output (PDF/SVG), embed the raw markers as one bitmap instead
+    # of one vector marker per point. No effect on Agg/PNG output.
+    raw.set_rasterized(True)
 
     lines = [raw]
     legend_labels = ["raw data"]
@@ -84,12 +133,11 @@ def write_plot(time, avg_temps, use_timestamp=False, marker_size=1):
 #%%
 # https://stackoverflow.com/questions/24885092/finding-the-consecutive-zeros-in-a-numpy-array
 def zero_runs(a):
-    # Create an array that is 1 where a is 0, and pad each end with an extra 0.
-    iszero = np.concatenate(([0], np.equal(a, 0).view(np.int8), [0]))
-    absdiff = np.abs(np.diff(iszero))
-    # Runs start and end where absdiff is 1.
-    ranges = np.where(absdiff == 1)[0].reshape(-1, 2)
-    return ranges
+    # Create an array that is True where a is 0, and pad each end with False.
+    iszero = np.concatenate(([False], a == 0, [False]))
+    # Runs start and end where neighbouring elements differ.
+    edges = np.flatnonzero(iszero[1:] != iszero[:-1])
+    return edges.reshape(-1, 2)
 
 #%%
 def write_hist(zeros):
@@ -110,11 +158,20 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--json-out", type=str, default="dump.json", help="Dump JSON to file from URL (does nothing when --json-in is supplied). Default: dump.json.")
     parser.add_argument("-w", "--windows", type=int, nargs="+", metavar="N", default=[15, 30, 60], help="Plot sliding window averages over N seconds. '0' means 'do not plot averages'. Default: [15, 30, 60].")
     parser.add_argument("-t", "--timestamp", action="store_true", help="Use timestamps in plot instead of starting at 0 seconds.")
+    parser.add_argument("-g", "--gpu", action="store_true", help="Compute sliding window averages on the GPU (requires cupy and a CUDA device; falls back to CPU otherwise).")
     parser.add_argument("-m", "--marker-size", type=int, default=1, help="Marker size of the raw data. Default: 1.")
     parser.add_argument("-f", "--figure-out", type=str, default="plot.png", help="Output plot filename. Default: plot.png.")
+    parser.add_argument("-r", "--dpi", type=int, default=None, help="Resolution of output images in dots per inch. Default: matplotlib's savefig.dpi setting.")
     parser.add_argument("-z", "--histogram", type=str, default="zero.png", help="Histogram of runs of constant data. Default: zero.png.")
     args = parser.parse_args()
 
+    # For the plot step below once it's re-enabled: split long line paths
+    # (the smoothed averages; the raw series is markers only) so Agg doesn't
+    # choke on millions of vertices. The histogram isn't affected. Agg reads
+    # this in savefig, so it's set here rather than in write_plot; importing
+    # plot.py leaves rcParams alone.
+    plt.rcParams['agg.path.chunksize'] = 10000
+
     print("Grabbing data...")
     if args.url:
         json_data = grab_data_url(args.url, args.json_out)
@@ -122,22 +179,27 @@ if __name__ == "__main__":
         json_data = grab_data_file(args.json_in)
 
     print("Processing data...")
-    time, avg_temps = process_data(json_data, use_timestamp=args.timestamp, windows=args.windows)
+    time, avg_temps = process_data(json_data, use_timestamp=args.timestamp, windows=args.windows, use_gpu=args.gpu)
 
     # print("Creating plot...")
     # fig = write_plot(time, avg_temps, use_timestamp=args.timestamp, marker_size=args.marker_size)
-    # fig.savefig(args.figure_out)
+    # fig.savefig(args.figure_out, dpi=args.dpi)
 
     print("Generating distribution...")
     diffs = np.diff(avg_temps[0])
+    nz_mask = diffs != 0.0
+    num_nonzero = nz_mask.sum()
     runs = zero_runs(diffs)
     run_length = runs[:,1] - runs[:,0]
-    rl_values, rl_counts = np.unique(run_length, return_counts=True)
+    # Run lengths are small non-negative ints; counting beats sorting.
+    counts = np.bincount(run_length)
+    rl_values = np.nonzero(counts)[0]
+    rl_counts = counts[rl_values]
 
     print("  {} total measurements".format(len(avg_temps[0])))
     print("  {} unique zero runs".format(np.sum(rl_counts)))
     print("  {} total zero bits".format(np.sum(rl_values * rl_counts)))
-    print("  {} total non-zero diffs".format(len(diffs[diffs != 0.0])))
+    print("  {} total non-zero diffs".format(num_nonzero))
     rl_counts_norm = rl_counts / np.sum(rl_counts)
 
     hfig, ax = plt.subplots(figsize=(10, 8))
@@ -146,10 +208,10 @@ if __name__ == "__main__":
            title="Zero runs bit count")
     ax.bar(rl_values , rl_counts_norm)
 
-    hfig.savefig(args.histogram)
+    hfig.savefig(args.histogram, dpi=args.dpi)
 
     print("Entropy calculations...")
-    theoretical_entropy = np.sum(rl_counts_norm*-np.log2(rl_counts_norm))
+    theoretical_entropy = -(rl_counts_norm @ np.log2(rl_counts_norm))
     print("  Theoretical (Zeros Only): {} bits/symbol".format(theoretical_entropy))
 
     # The length of the run == the number of zero bits stored per run.
@@ -163,15 +225,20 @@ if __name__ == "__main__":
     rle_bits_required = 4 + 8
                # 1  2  3  4  5  6  7  8  9  10 11 12 13  14  15  16
     rl_start =  [3, 4, 4, 6, 6, 6, 6, 6, 7, 7, 7, 7, 7, 7, 7, 7]
-    rl_rest = [rle_bits_required] * len(rl_values[(rl_values > len(rl_start))])
-
-    bits_per_codeword_rle = np.sum(np.concatenate((rl_start, rl_rest)) * rl_counts_norm)
+    # Look up the cost of each run length that actually occurs; anything
+    # past the table is emitted as an explicit run-length.
+    table = np.asarray(rl_start, dtype=np.int32)
+    in_table = rl_values <= len(table)
+    bits_vec = np.full(len(rl_values), rle_bits_required, dtype=np.int32)
+    bits_vec[in_table] = table[rl_values[in_table] - 1]
+
+    bits_per_codeword_rle = bits_vec @ rl_counts_norm
     print("  RLE: {} bits/symbol".format(bits_per_codeword_rle))
 
-    rl_counts_bits = (np.concatenate((rl_start, rl_rest)) * rl_counts)
-    nonzero_counts_bits = [2 * len(diffs[diffs != 0.0])]
+    rl_counts_bits = bits_vec * rl_counts
+    nonzero_counts_bits = [2 * num_nonzero]
     abs_bits = [16]
-    total_symbols = (np.sum(rl_counts) + len(diffs[diffs != 0.0]) + 1)
+    total_symbols = (np.sum(rl_counts) + num_nonzero + 1)
     bits_per_codeword_all = np.sum(np.concatenate((abs_bits, nonzero_counts_bits, rl_counts_bits)))/total_symbols
     print("  All Symbols: {} bits/symbol".format(bits_per_codeword_all))
 
@@ -181,9 +248,9 @@ if __name__ == "__main__":
     bits_per_measurement = 12
     nonzero_bits = 2
 
-    total_zero_bits = np.sum(np.concatenate((rl_start, rl_rest)) * rl_counts)
+    total_zero_bits = bits_vec @ rl_counts
     # 4 bits per +/-1 increment.
-    total_nonzero_bits = np.sum(nonzero_bits*len(diffs[diffs != 0.0]))
+    total_nonzero_bits = np.sum(nonzero_bits*num_nonzero)
     total_compressed_bits = total_zero_bits + total_nonzero_bits + initial_abs_bits
     uncompressed_bits = bits_per_measurement*len(avg_temps[0])
 